@@ -1,26 +1,34 @@
-import json
+import atexit
 import logging
+import logging.handlers
 import math
 import os
-import random
+import queue
 import sys
 import time
 import asyncio
 import threading
+import functools
 import hashlib
-from dataclasses import dataclass, field, asdict
+import io
+from dataclasses import dataclass, field
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 from typing import Dict, Final, List, Optional
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+import httpx
+import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
 load_dotenv()
 
@@ -28,17 +36,91 @@ load_dotenv()
 # ──────────────────────────────────────────────
 # PostgreSQL helper
 # ──────────────────────────────────────────────
-def _get_pg_conn():
-    """Return a new psycopg2 connection using env vars."""
-    return psycopg2.connect(
+def _pg_params() -> dict:
+    return dict(
         host=os.getenv("POSTGRES_HOST", "localhost"),
         port=int(os.getenv("POSTGRES_PORT", "5432")),
         dbname=os.getenv("POSTGRES_DB", "energy_monitor"),
         user=os.getenv("POSTGRES_USER", "postgres"),
         password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+        connect_timeout=2,  # fail fast on an unreachable host instead of the ~2 min TCP default
     )
 
 
+def _get_pg_conn():
+    """Return a new psycopg2 connection using env vars (migrations only)."""
+    return psycopg2.connect(**_pg_params())
+
+
+POSTGRES_POOL_MAX: Final[int] = int(os.getenv("POSTGRES_POOL_MAX", "10"))
+_pg_pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+_pg_pool_lock = threading.Lock()
+# getconn() raises PoolError instead of waiting once every connection is out,
+# and DB work arrives from the default executor (more threads than
+# connections), so borrowers wait here for a free slot.
+_pg_pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX)
+
+
+def _get_pg_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Shared pool, created on first use so the app still starts without a DB."""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                _pg_pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, POSTGRES_POOL_MAX, **_pg_params()
+                )
+    return _pg_pool
+
+
+@contextmanager
+def _pg_conn():
+    """Borrow a pooled connection; commits on success, rolls back on error so
+    the connection goes back idle. Broken connections are discarded."""
+    pool = _get_pg_pool()
+    with _pg_pool_slots:
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+
+def _fetch_dicts(sql: str, params=None) -> List[dict]:
+    """Run a read query on a pooled connection and return its rows
+    (RealDictRow is a dict subclass, so no per-row copy is needed)."""
+    with _pg_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+# Dashboards poll the /api/* lists every few seconds; within the TTL every
+# client gets the same rows and concurrent misses share one DB round-trip.
+API_CACHE_TTL_SEC: Final = float(os.getenv("API_CACHE_TTL_SEC", "3"))
+_api_cache: Dict[str, tuple] = {}
+_api_cache_locks: Dict[str, asyncio.Lock] = {}
+
+async def _cached_fetch(key: str, sql: str) -> List[dict]:
+    """_fetch_dicts off the event loop, memoized for API_CACHE_TTL_SEC.
+    Errors propagate and are never cached."""
+    hit = _api_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    lock = _api_cache_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        hit = _api_cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        rows = await asyncio.to_thread(_fetch_dicts, sql)
+        _api_cache[key] = (time.monotonic() + API_CACHE_TTL_SEC, rows)
+        return rows
+
+
 def _run_migrations():
     """Ensure all required tables exist with correct column names.
 
@@ -48,7 +130,8 @@ def _run_migrations():
       2. Rename old columns to match n8n workflow expectations
       3. ADD COLUMN IF NOT EXISTS for missing columns
       4. Create indexes (using correct column names)
-      5. Seed relay_states
+      5. Create materialized views
+      6. Seed relay_states
     """
 
     # Step 1: Create tables if they don't exist (fresh DB)
@@ -267,15 +350,29 @@ def _run_migrations():
     CREATE INDEX IF NOT EXISTS idx_agent_decisions_agent ON agent_decisions (agent_name);
     CREATE INDEX IF NOT EXISTS idx_incidentes_estado ON incidentes (estado);
     CREATE INDEX IF NOT EXISTS idx_incidentes_area ON incidentes (area);
+    CREATE INDEX IF NOT EXISTS idx_incidentes_apertura ON incidentes (timestamp_apertura DESC);
     CREATE INDEX IF NOT EXISTS idx_feedback_tipo ON feedback (tipo);
+    CREATE INDEX IF NOT EXISTS idx_feedback_ts ON feedback (timestamp DESC);
     CREATE INDEX IF NOT EXISTS idx_correlaciones_ts ON correlaciones (timestamp DESC);
     CREATE INDEX IF NOT EXISTS idx_alert_history_hash ON alert_history (hash_contenido);
     CREATE INDEX IF NOT EXISTS idx_alert_history_area_ts ON alert_history (area, timestamp DESC);
     CREATE INDEX IF NOT EXISTS idx_mantenimiento_area ON mantenimiento_preventivo (area);
     CREATE INDEX IF NOT EXISTS idx_mantenimiento_estado ON mantenimiento_preventivo (estado);
+    CREATE INDEX IF NOT EXISTS idx_mantenimiento_ts ON mantenimiento_preventivo (timestamp DESC);
     """
 
-    # Step 5: Seed relay_states
+    # Step 5: Materialized views (refreshed in the background by the app)
+    views = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS mv_agent_stats AS
+        SELECT agent_name,
+               COUNT(*)       AS decisions,
+               MAX(timestamp) AS last_active
+        FROM agent_decisions
+        GROUP BY agent_name;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_agent_stats_agent ON mv_agent_stats (agent_name);
+    """
+
+    # Step 6: Seed relay_states
     seed = """
     INSERT INTO relay_states (area, estado) VALUES
         ('laboratorio_computo', 'ENCENDIDO'),
@@ -296,38 +393,73 @@ def _run_migrations():
         ("rename_columns", rename_columns),
         ("add_columns", add_columns),
         ("fix_indexes", fix_indexes),
+        ("views", views),
         ("seed_data", seed),
     ]
 
-    for attempt in range(1, 11):
+    # All steps in one round-trip. Postgres runs a multi-statement query as a
+    # single implicit transaction, so a failure leaves nothing half-applied
+    # and the per-step path below can take over.
+    full_sql = "\n".join(sql for _, sql in steps)
+
+    # Exponential backoff (0.1s, 0.2s, 0.4s … capped at 5s) within a 30s budget:
+    # an already-up DB costs nothing, a slow one is polled quickly at first.
+    # Only connection errors are retried; an SQL error would just repeat.
+    deadline = time.monotonic() + 30.0
+    delay = 0.1
+    conn = None
+    attempt = 0
+    while True:
+        attempt += 1
+        step_name = "connect"
         try:
-            conn = _get_pg_conn()
-            conn.autocommit = True
-            cur = conn.cursor()
-            for step_name, sql in steps:
-                cur.execute(sql)
-            cur.close()
+            if conn is None or conn.closed:
+                conn = _get_pg_conn()
+                conn.autocommit = True
+            with conn.cursor() as cur:
+                step_name = "combined_batch"
+                try:
+                    cur.execute(full_sql)
+                except psycopg2.OperationalError:
+                    raise
+                except psycopg2.Error as exc:
+                    print(f"[MIGRATION] Combined batch rejected ({exc}); running steps one by one",
+                          file=sys.stderr)
+                    for step_name, sql in steps:
+                        cur.execute(sql)
             conn.close()
             return True
+        except psycopg2.OperationalError as exc:
+            if time.monotonic() + delay < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                continue
+            print(f"[MIGRATION] FAILED after {attempt} attempts at step '{step_name}': {exc}",
+                  file=sys.stderr)
         except Exception as exc:
-            if attempt < 10:
-                time.sleep(2)
-            else:
-                print(f"[MIGRATION] FAILED after 10 attempts: {exc}", file=sys.stderr)
-                return False
+            print(f"[MIGRATION] FAILED at step '{step_name}': {exc}", file=sys.stderr)
+        if conn is not None:
+            conn.close()
+        return False
 
 
 # ──────────────────────────────────────────────
 # Logging setup
 # ──────────────────────────────────────────────
+# Records are formatted by the QueueHandler and written to stdout by a
+# listener thread, so log I/O never blocks the simulation thread.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(name)s — %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
     handlers=[
-        logging.StreamHandler(sys.stdout),
+        logging.handlers.QueueHandler(_log_queue),
     ],
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 log = logging.getLogger("EnergySimProWeb")
 
 # ──────────────────────────────────────────────
@@ -351,7 +483,7 @@ class RelayState(str, Enum):
     ENCENDIDO = "ENCENDIDO"
     APAGADO   = "APAGADO"
 
-@dataclass
+@dataclass(slots=True)
 class AreaProfile:
     base: float
     nocturno: float
@@ -361,7 +493,7 @@ class AreaProfile:
     devices: int = 1
     floor: int = 1
 
-@dataclass
+@dataclass(slots=True)
 class SensorReading:
     area: str
     kwh: float
@@ -378,10 +510,54 @@ class SensorReading:
     floor: int
     sequence: int
     relay_state: str = "ENCENDIDO"
+    drift_factor: float = 1.0
     tags: List[str] = field(default_factory=list)
 
     def to_dict(self) -> dict:
-        return asdict(self)
+        # Shallow, explicit copy — asdict() deep-copies recursively per call.
+        # Floats go out at full precision (no round()): consumers use the
+        # value, and display code formats it (n8n toFixed(4), the log line).
+        # Same schema as sensor_sim: sensor_id, floor and device_count live on
+        # the retained <prefix>/<area>/meta topic, not in every reading.
+        d = {
+            "area": self.area, "kwh": self.kwh, "timestamp": self.timestamp,
+            "modo": self.modo,
+            "voltage": self.voltage, "current": self.current,
+            "power_factor": self.power_factor,
+            "temperature_c": self.temperature_c,
+            "humidity_pct": self.humidity_pct,
+            "quality": self.quality, "sequence": self.sequence,
+            "relay_state": self.relay_state,
+        }
+        # drift_factor only means something for a drifting area (as in sensor_sim)
+        if self.modo == SimMode.GRADUAL_DRIFT.value:
+            d["drift_factor"] = self.drift_factor
+        d["tags"] = list(self.tags)
+        return d
+
+@dataclass(frozen=True, slots=True)
+class TickContext:
+    """One clock read per tick: UTC for timestamps, local time for the
+    daily/seasonal profile curves."""
+    timestamp: str
+    hour: int
+    hour_frac: float
+    month: int
+    night: bool
+    season: float
+
+    @classmethod
+    def now(cls) -> "TickContext":
+        now = datetime.now(timezone.utc)
+        local = now.astimezone()
+        return cls(
+            timestamp=now.isoformat(),
+            hour=local.hour,
+            hour_frac=local.hour + local.minute / 60.0,
+            month=local.month,
+            night=_is_night(local.hour),
+            season=_seasonal_factor(local.month),
+        )
 
 AREAS: Final[Dict[str, AreaProfile]] = {
     "laboratorio_computo": AreaProfile(base=8.5,  nocturno=1.2,  std_pct=0.08, peak_hour=14, peak_factor=1.30, devices=40, floor=2),
@@ -412,6 +588,13 @@ class AppState:
         self.recent_alerts: Dict[str, str] = {}
         # Feedback log in-memory (fallback)
         self.feedback_log: List[dict] = []
+        # WebSocket messages discarded because the broadcast queue was full
+        self.broadcast_dropped: int = 0
+        # Areas currently in FLOOD mode (kept in sync by update_config)
+        self.flood_count: int = 0
+
+    def refresh_flood_count(self):
+        self.flood_count = sum(1 for m in self.area_modes.values() if m == SimMode.FLOOD)
 
 state = AppState()
 
@@ -423,43 +606,75 @@ PASSWORD: Final[str] = os.getenv("MQTT_PASS", "")
 QOS: Final[int] = int(os.getenv("MQTT_QOS", "0"))
 TOPIC_PREFIX: Final[str] = os.getenv("TOPIC_PREFIX", "edificio")
 BUILDING_ID: Final[str] = os.getenv("BUILDING_ID", "edificio_principal")
+# "per_area": one message per reading on <prefix>/<area>/consumo plus
+#             <prefix>/summary (what the n8n ingest workflow subscribes to).
+# "batch":    a single message per tick on <prefix>/batch:
+#             {"building_id", "timestamp", "readings": [reading...], "summary": {...}}
+MQTT_LAYOUT: Final[str] = os.getenv("MQTT_LAYOUT", "per_area")
+
+# Per-area strings that never change — built once instead of every tick
+AREA_NAMES: Final[tuple] = tuple(AREAS)
+AREA_ITEMS: Final[tuple] = tuple(AREAS.items())
+SENSOR_IDS: Final[Dict[str, str]] = {a: f"{BUILDING_ID}_{a}_s{p.floor:02d}" for a, p in AREAS.items()}
+TOPICS: Final[Dict[str, str]] = {a: f"{TOPIC_PREFIX}/{a}/consumo" for a in AREAS}
+META_TOPICS: Final[Dict[str, str]] = {a: f"{TOPIC_PREFIX}/{a}/meta" for a in AREAS}
+# Static per-area metadata, published retained on connect (as sensor_sim does)
+_META_PAYLOADS: Final[Dict[str, bytes]] = {
+    a: orjson.dumps({"area": a, "building_id": BUILDING_ID, "sensor_id": SENSOR_IDS[a],
+                     "floor": p.floor, "device_count": p.devices})
+    for a, p in AREAS.items()
+}
+SUMMARY_TOPIC: Final[str] = f"{TOPIC_PREFIX}/summary"
+BATCH_TOPIC: Final[str] = f"{TOPIC_PREFIX}/batch"
 
 # ──────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────
-def _gaussian_noise(mean: float, std_pct: float) -> float:
-    factor = random.gauss(1.0, std_pct)
+def _gaussian_noise(mean: float, std_pct: float, z: float) -> float:
+    # z is a pre-drawn standard normal sample (see simulation_loop)
+    factor = 1.0 + z * std_pct
     return max(0.01, mean * factor)
 
-def _seasonal_factor() -> float:
-    month = datetime.now().month
-    seasonal = {12: 1.05, 1: 1.05, 2: 1.04, 3: 1.02, 4: 1.00, 5: 0.99, 6: 0.97, 7: 0.96, 8: 0.97, 9: 0.98, 10: 1.00, 11: 1.02}
-    return seasonal.get(month, 1.0)
-
-def _hourly_factor(profile: AreaProfile) -> float:
-    hour = datetime.now().hour + datetime.now().minute / 60.0
-    distance = abs(hour - profile.peak_hour)
-    if distance > 12:
-        distance = 24 - distance
-    bell = math.exp(-0.5 * (distance / 3.0) ** 2)
-    return 1.0 + (profile.peak_factor - 1.0) * bell
-
-def _is_night() -> bool:
-    h = datetime.now().hour
-    return h < 6 or h >= 22
-
-def _simulate_env() -> tuple[float, float]:
-    hour = datetime.now().hour
-    temp = 18 + 10 * math.sin(math.pi * (hour - 6) / 12) + random.gauss(0, 0.5)
-    temp = round(max(15.0, min(35.0, temp)), 1)
-    hum = 75 - 35 * math.sin(math.pi * (hour - 6) / 12) + random.gauss(0, 1.5)
-    hum = round(max(20.0, min(95.0, hum)), 1)
+# Seasonal factor indexed by month (index 0 unused)
+_SEASONAL: Final[tuple] = (1.0, 1.05, 1.04, 1.02, 1.00, 0.99, 0.97, 0.96, 0.97, 0.98, 1.00, 1.02, 1.05)
+
+def _seasonal_factor(month: int) -> float:
+    return _SEASONAL[month]
+
+# Per-area profile constants as parallel arrays (AREAS order)
+_BASE_ARR: Final[np.ndarray] = np.array([p.base for p in AREAS.values()])
+_NOCT_ARR: Final[np.ndarray] = np.array([p.nocturno for p in AREAS.values()])
+_PEAK_HOUR_ARR: Final[np.ndarray] = np.array([p.peak_hour for p in AREAS.values()], dtype=float)
+_PEAK_FACTOR_ARR: Final[np.ndarray] = np.array([p.peak_factor for p in AREAS.values()])
+
+@functools.lru_cache(maxsize=4)
+def _base_kwh_vector(night: bool, season: float, hour_frac: float) -> tuple:
+    """Baseline kWh for every area (AREAS order) in one array pass.
+    Memoized: the inputs only change once a minute."""
+    distance = np.abs(hour_frac - _PEAK_HOUR_ARR)
+    distance = np.minimum(distance, 24 - distance)
+    # exp(-0.5 * (d / 3)^2) == exp(-d*d / 18), without the float pow
+    bell = np.exp(-distance * distance / 18.0)
+    hourly = 1.0 + (_PEAK_FACTOR_ARR - 1.0) * bell
+    base = _NOCT_ARR if night else _BASE_ARR
+    return tuple((base * hourly * season).tolist())
+
+def _is_night(hour: int) -> bool:
+    return hour < 6 or hour >= 22
+
+# Daily temperature/humidity curves depend only on the integer hour
+_TEMP_TABLE: Final[tuple] = tuple(18 + 10 * math.sin(math.pi * (h - 6) / 12) for h in range(24))
+_HUM_TABLE: Final[tuple] = tuple(75 - 35 * math.sin(math.pi * (h - 6) / 12) for h in range(24))
+
+def _simulate_env(hour: int, z_temp: float, z_hum: float) -> tuple[float, float]:
+    temp = _TEMP_TABLE[hour] + 0.5 * z_temp
+    temp = max(15.0, min(35.0, temp))
+    hum = _HUM_TABLE[hour] + 1.5 * z_hum
+    hum = max(20.0, min(95.0, hum))
     return temp, hum
 
-def _simulate_electrical(kwh: float) -> tuple[float, float, float]:
-    voltage = round(random.gauss(220.0, 2.0), 1)
-    pf = round(random.uniform(0.85, 0.98), 3)
-    current = round((kwh * 1000) / (voltage * pf), 2)
+def _simulate_electrical(kwh: float, voltage: float, pf: float) -> tuple[float, float, float]:
+    current = (kwh * 1000) / (voltage * pf)
     return voltage, current, pf
 
 # ──────────────────────────────────────────────
@@ -471,21 +686,21 @@ class SensorSimulator:
         self._seq:   Dict[str, int]   = {a: 0   for a in AREAS}
         self._intermittent_skip: Dict[str, bool] = {}
 
-    def _base_kwh(self, area: str, profile: AreaProfile) -> float:
-        base = profile.nocturno if _is_night() else profile.base
-        return base * _hourly_factor(profile) * _seasonal_factor()
-
-    def get_reading(self, area: str, profile: AreaProfile) -> Optional[SensorReading]:
+    def get_reading(self, area: str, profile: AreaProfile, ctx: TickContext,
+                    temp: float, hum: float, base: float,
+                    z: float, voltage: float, pf: float) -> Optional[SensorReading]:
+        """Build one reading from the caller's per-tick values (clock context,
+        building temperature/humidity) — these don't depend on the area, so
+        they're computed once. `base` is this area's entry of
+        _base_kwh_vector; z/voltage/pf its slice of the tick's RNG draw."""
         self._seq[area] += 1
-        now_utc = datetime.now(timezone.utc).isoformat()
-        temp, hum = _simulate_env()
         tags: List[str] = []
 
         # ── Check relay state — if OFF, produce zero reading ──
         if state.relay_states.get(area) == RelayState.APAGADO:
             return SensorReading(
-                area=area, kwh=0.0, timestamp=now_utc,
-                modo="relay_off", sensor_id=f"{BUILDING_ID}_{area}_s{profile.floor:02d}",
+                area=area, kwh=0.0, timestamp=ctx.timestamp,
+                modo="relay_off", sensor_id=SENSOR_IDS[area],
                 voltage=0.0, current=0.0, power_factor=0.0,
                 temperature_c=temp, humidity_pct=hum, quality="relay_off",
                 device_count=0, floor=profile.floor,
@@ -506,65 +721,108 @@ class SensorSimulator:
                 return None
             tags.append("intermittent_recovery")
 
-        base = self._base_kwh(area, profile)
-
         if mode == SimMode.GRADUAL_DRIFT:
-            self._drift[area] = min(self._drift[area] + 0.02, 3.0)
-            kwh = round(_gaussian_noise(base * self._drift[area], profile.std_pct), 4)
-            tags.append(f"drift_factor:{self._drift[area]:.2f}")
+            self._drift[area] = min(round(self._drift[area] + 0.02, 2), 3.0)
+            kwh = _gaussian_noise(base * self._drift[area], profile.std_pct, z)
             quality = "degraded" if self._drift[area] > 1.5 else "ok"
 
         elif mode == SimMode.ANOMALY:
-            kwh = round(_gaussian_noise(base * 2.8, 0.05), 4)
+            kwh = _gaussian_noise(base * 2.8, 0.05, z)
             tags.append("spike_anomaly")
             quality = "degraded"
 
-        elif mode == SimMode.NIGHT_ANOMALY and _is_night():
-            kwh = round(_gaussian_noise(base * 3.5, 0.05), 4)
+        elif mode == SimMode.NIGHT_ANOMALY and ctx.night:
+            kwh = _gaussian_noise(base * 3.5, 0.05, z)
             tags.append("night_spike")
             quality = "degraded"
 
         else:
-            kwh = round(_gaussian_noise(base, profile.std_pct), 4)
+            kwh = _gaussian_noise(base, profile.std_pct, z)
             quality = "ok"
 
-        voltage, current, pf = _simulate_electrical(kwh)
+        voltage, current, pf = _simulate_electrical(kwh, voltage, pf)
 
         return SensorReading(
-            area=area, kwh=kwh, timestamp=now_utc, modo=mode.value,
-            sensor_id=f"{BUILDING_ID}_{area}_s{profile.floor:02d}",
+            area=area, kwh=kwh, timestamp=ctx.timestamp, modo=mode.value,
+            sensor_id=SENSOR_IDS[area],
             voltage=voltage, current=current, power_factor=pf,
             temperature_c=temp, humidity_pct=hum, quality=quality,
             device_count=profile.devices, floor=profile.floor,
             sequence=self._seq[area],
             relay_state=state.relay_states.get(area, RelayState.ENCENDIDO).value,
+            drift_factor=self._drift[area],
             tags=tags,
         )
 
 # ──────────────────────────────────────────────
 # WebSockets and Broadcast Queue
 # ──────────────────────────────────────────────
+CLIENT_QUEUE_MAX: Final[int] = 256
+
+def _coalesce(msgs: List[bytes]) -> bytes:
+    """One frame for a run of already-encoded JSON messages (spliced, not re-encoded)."""
+    if len(msgs) == 1:
+        return msgs[0]
+    return b'{"type":"batch","items":[' + b",".join(msgs) + b"]}"
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Each client has its own bounded outbox drained by a sender task, so
+        # a slow socket only delays itself and never the broadcast.
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self._senders: Dict[WebSocket, asyncio.Task] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_MAX)
+        self.active_connections[websocket] = outbox
+        self._senders[websocket] = asyncio.create_task(self._sender(websocket, outbox))
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        task = self._senders.pop(websocket, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
 
-    async def broadcast(self, message: dict):
-        for connection in list(self.active_connections):
-            try:
-                await connection.send_json(message)
-            except Exception:
-                self.active_connections.remove(connection)
+    async def _sender(self, websocket: WebSocket, outbox: asyncio.Queue):
+        try:
+            while True:
+                # Whatever piled up while the last send was in flight goes out
+                # as a single batch frame
+                msgs = [await outbox.get()]
+                while not outbox.empty():
+                    msgs.append(outbox.get_nowait())
+                await websocket.send_bytes(_coalesce(msgs))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(websocket)
+
+    async def broadcast(self, message: bytes | dict):
+        # Callers normally hand over pre-encoded JSON; encode dicts once here
+        data = message if isinstance(message, bytes) else orjson.dumps(message)
+        for outbox in self.active_connections.values():
+            if outbox.full():
+                # Slow client: drop its oldest frame rather than grow without bound
+                outbox.get_nowait()
+                state.broadcast_dropped += 1
+            outbox.put_nowait(data)
 
 manager = ConnectionManager()
-broadcast_queue = asyncio.Queue()
+BROADCAST_QUEUE_MAX: Final[int] = 1000
+broadcast_queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_MAX)
+
+def _enqueue_broadcast(msg: bytes):
+    """Runs on the event loop; drops the oldest message when the queue is full
+    so a slow client can't make memory grow without bound."""
+    if broadcast_queue.full():
+        broadcast_queue.get_nowait()
+        broadcast_queue.task_done()
+        state.broadcast_dropped += 1
+        if state.broadcast_dropped % 100 == 1:
+            log.warning("WebSocket broadcast queue full — %d messages dropped so far",
+                        state.broadcast_dropped)
+    broadcast_queue.put_nowait(msg)
 
 async def broadcast_worker():
     while True:
@@ -577,18 +835,23 @@ async def broadcast_worker():
 # ──────────────────────────────────────────────
 _mqtt_client_ref: Optional[mqtt.Client] = None
 
+RELAY_OFF_ACTIONS: Final = frozenset({"cortar_energia", "corte_emergencia", "apagar"})
+RELAY_ON_ACTIONS: Final = frozenset({"restaurar_energia", "encender", "restablecer"})
+
 def _on_mqtt_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
         log.info("✅  MQTT connected — subscribing to control topics")
         client.subscribe(f"{TOPIC_PREFIX}/+/comando", qos=QOS)
         client.subscribe(f"{TOPIC_PREFIX}/system/comando", qos=QOS)
+        for area, payload in _META_PAYLOADS.items():
+            client.publish(META_TOPICS[area], payload, qos=QOS, retain=True)
     else:
         log.error("❌  MQTT connection failed: %s", reason_code)
 
 def _on_mqtt_message(client, userdata, msg):
     """Process incoming control commands."""
     try:
-        payload = json.loads(msg.payload.decode("utf-8"))
+        payload = orjson.loads(msg.payload)
         topic = msg.topic
         parts = topic.split("/")
         area = parts[1] if len(parts) >= 3 and parts[1] != "system" else None
@@ -598,24 +861,24 @@ def _on_mqtt_message(client, userdata, msg):
         
         log.info("📨  Command: %s on %s from %s", accion, area or "system", origen)
         
-        if accion in ("cortar_energia", "corte_emergencia", "apagar"):
-            targets = [area] if area and area in AREAS else list(AREAS.keys())
-            for a in targets:
-                state.relay_states[a] = RelayState.APAGADO
-                state.relay_reasons[a] = motivo
-                state.relay_changed_by[a] = origen
+        if accion in RELAY_OFF_ACTIONS:
+            targets = (area,) if area and area in AREAS else AREA_NAMES
+            state.relay_states.update(dict.fromkeys(targets, RelayState.APAGADO))
+            state.relay_reasons.update(dict.fromkeys(targets, motivo))
+            state.relay_changed_by.update(dict.fromkeys(targets, origen))
             # ACK
             ack = {"area": area or "system", "relay_state": "APAGADO", "motivo": motivo, "ts": datetime.now(timezone.utc).isoformat()}
-            client.publish(f"{TOPIC_PREFIX}/system/relay_ack", json.dumps(ack), qos=QOS)
+            client.publish(f"{TOPIC_PREFIX}/system/relay_ack", orjson.dumps(ack), qos=QOS)
+            userdata.call_soon_threadsafe(_broadcast_relays)
             
-        elif accion in ("restaurar_energia", "encender", "restablecer"):
-            targets = [area] if area and area in AREAS else list(AREAS.keys())
-            for a in targets:
-                state.relay_states[a] = RelayState.ENCENDIDO
-                state.relay_reasons[a] = motivo
-                state.relay_changed_by[a] = origen
+        elif accion in RELAY_ON_ACTIONS:
+            targets = (area,) if area and area in AREAS else AREA_NAMES
+            state.relay_states.update(dict.fromkeys(targets, RelayState.ENCENDIDO))
+            state.relay_reasons.update(dict.fromkeys(targets, motivo))
+            state.relay_changed_by.update(dict.fromkeys(targets, origen))
             ack = {"area": area or "system", "relay_state": "ENCENDIDO", "motivo": motivo, "ts": datetime.now(timezone.utc).isoformat()}
-            client.publish(f"{TOPIC_PREFIX}/system/relay_ack", json.dumps(ack), qos=QOS)
+            client.publish(f"{TOPIC_PREFIX}/system/relay_ack", orjson.dumps(ack), qos=QOS)
+            userdata.call_soon_threadsafe(_broadcast_relays)
             
     except Exception as e:
         log.error("Error processing MQTT command: %s", e)
@@ -627,13 +890,25 @@ def _on_mqtt_message(client, userdata, msg):
 def simulation_loop(loop: asyncio.AbstractEventLoop):
     global _mqtt_client_ref
     client = mqtt.Client(
-        client_id=f"sensor_sim_web_{random.randint(1000,9999)}",
+        # Stable id, but a clean session: a persistent one would have the
+        # broker replay relay commands (corte_emergencia…) queued while we
+        # were down. Subscriptions are re-made in _on_mqtt_connect anyway.
+        client_id=f"sensor_sim_web_{BUILDING_ID}",
+        clean_session=True,
+        userdata=loop,  # lets command callbacks schedule WebSocket pushes
         protocol=mqtt.MQTTv311,
         callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
     )
     if USERNAME:
         client.username_pw_set(USERNAME, PASSWORD)
-    
+
+    # Widen paho's in-flight window so QoS>0 bursts (FLOOD) are pipelined
+    # instead of waiting on PUBACKs. The outgoing queue stays bounded (as in
+    # sensor_sim) so a broker outage cannot grow it without limit; publish()
+    # beyond it returns MQTT_ERR_QUEUE_SIZE instead.
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(1000)
+
     # Bidirectional MQTT callbacks
     client.on_connect = _on_mqtt_connect
     client.on_message = _on_mqtt_message
@@ -648,62 +923,92 @@ def simulation_loop(loop: asyncio.AbstractEventLoop):
         mqtt_connected = False
 
     sim = SensorSimulator()
+    rng = np.random.default_rng()
+    n_areas = len(AREAS)
+    per_area = MQTT_LAYOUT != "batch"
 
+    # Fixed-rate schedule: the tick period is the interval itself, not
+    # interval + work time. An overrun resets the schedule instead of bursting.
+    next_tick = time.monotonic()
     while state.running:
-        iterations = 10 if SimMode.FLOOD in state.area_modes.values() else 1
+        iterations = 10 if state.flood_count > 0 else 1
         for _ in range(iterations):
+            next_tick += state.interval_sec / iterations
             total_kwh = 0.0
             published = 0
-
-            for area, profile in AREAS.items():
-                r = sim.get_reading(area, profile)
+            ctx = TickContext.now()
+            # All randomness for the tick in two vectorized draws: one normal
+            # block (kwh noise per area, voltage per area, temp, hum) + pf
+            z = rng.standard_normal(2 * n_areas + 2)
+            z_all = z[:n_areas].tolist() + z[-2:].tolist()
+            volts = (220.0 + 2.0 * z[n_areas:2 * n_areas]).tolist()
+            pfs = rng.uniform(0.85, 0.98, n_areas).tolist()
+            temp, hum = _simulate_env(ctx.hour, z_all[-2], z_all[-1])
+            base_kwh = _base_kwh_vector(ctx.night, ctx.season, ctx.hour_frac)
+            # Headless runs (no dashboard open) skip the WebSocket frame
+            # entirely: no log lines, no tick dict, no encode, no hop.
+            ws_clients = bool(manager.active_connections)
+            log_lines = ws_clients or log.isEnabledFor(logging.DEBUG)
+            readings: List[dict] = []
+            tick_readings: List[dict] = []
+
+            for i, (area, profile) in enumerate(AREA_ITEMS):
+                r = sim.get_reading(area, profile, ctx, temp, hum,
+                                    base_kwh[i], z_all[i], volts[i], pfs[i])
                 if not r:
                     continue
 
-                topic = f"{TOPIC_PREFIX}/{area}/consumo"
                 payload_dict = r.to_dict()
-                payload = json.dumps(payload_dict)
-
-                if mqtt_connected:
-                    client.publish(topic, payload, qos=QOS)
+                if mqtt_connected and per_area:
+                    client.publish(TOPICS[area], orjson.dumps(payload_dict), qos=QOS)
 
                 total_kwh += r.kwh
                 published += 1
 
-                mode = state.area_modes.get(area, SimMode.NORMAL)
-                log_line = f"[{mode.value}] {area} {r.kwh:.2f} kWh | V:{r.voltage:.1f} I:{r.current:.2f}A Q:{r.quality}"
-                log.info(log_line)
-                
-                # Send to WebSockets
-                asyncio.run_coroutine_threadsafe(
-                    broadcast_queue.put({
-                        "type": "reading",
-                        "data": payload_dict,
-                        "log": log_line
-                    }), 
-                    loop
-                )
+                readings.append(payload_dict)
+                if log_lines:
+                    mode = state.area_modes.get(area, SimMode.NORMAL)
+                    log_line = f"[{mode.value}] {area} {r.kwh:.2f} kWh | V:{r.voltage:.1f} I:{r.current:.2f}A Q:{r.quality}"
+                    log.debug(log_line)
+                    if ws_clients:
+                        tick_readings.append({"data": payload_dict, "log": log_line})
 
             summary_data = {
                 "building_id": BUILDING_ID,
-                "total_kwh": round(total_kwh, 4),
+                "total_kwh": total_kwh,
                 "areas_reporting": published,
                 "areas_total": len(AREAS),
                 "mode": "mixed",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": ctx.timestamp,
             }
             if mqtt_connected:
-                client.publish(f"{TOPIC_PREFIX}/summary", json.dumps(summary_data), qos=QOS)
-            
-            asyncio.run_coroutine_threadsafe(
-                broadcast_queue.put({
-                    "type": "summary",
-                    "data": summary_data
-                }), 
-                loop
-            )
-
-        time.sleep(state.interval_sec)
+                if per_area:
+                    client.publish(SUMMARY_TOPIC, orjson.dumps(summary_data), qos=QOS)
+                else:
+                    client.publish(BATCH_TOPIC, orjson.dumps({
+                        "building_id": BUILDING_ID,
+                        "timestamp": ctx.timestamp,
+                        "readings": readings,
+                        "summary": summary_data,
+                    }), qos=QOS)
+            log.info("📊  Tick — %d/%d areas | Total: %.2f kWh", published, len(AREAS), total_kwh)
+
+            # One WebSocket message per tick (all readings + summary), encoded
+            # here on the simulation thread rather than on the event loop
+            if ws_clients:
+                loop.call_soon_threadsafe(_enqueue_broadcast, orjson.dumps({
+                    "type": "tick",
+                    "readings": tick_readings,
+                    "summary": summary_data,
+                }))
+
+            # Spread FLOOD iterations evenly across the interval so the publish
+            # rate stays predictable (and QoS>0 in-flight windows can drain).
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
 
     if mqtt_connected:
         client.loop_stop()
@@ -724,6 +1029,8 @@ async def lifespan(app: FastAPI):
 
     # Startup logic
     asyncio.create_task(broadcast_worker())
+    asyncio.create_task(agent_stats_refresher())
+    writer = asyncio.create_task(feedback_writer())
     
     loop = asyncio.get_running_loop()
     thread = threading.Thread(target=simulation_loop, args=(loop,), daemon=True)
@@ -733,21 +1040,66 @@ async def lifespan(app: FastAPI):
     
     # Shutdown logic
     state.running = False
+    writer.cancel()
+    pending = _drain_feedback(_feedback_pending)
+    if pending:
+        try:
+            _insert_feedback(pending)
+        except Exception as exc:
+            log.warning("Could not persist %d feedback rows: %s", len(pending), exc)
+    if _http is not None:
+        await _http.aclose()
+    if _pg_pool is not None:
+        _pg_pool.closeall()
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson (FastAPI's own ORJSONResponse is
+    deprecated in recent releases)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+# Polled snapshots carry a content-hash ETag: browsers reuse them for a couple
+# of seconds, then revalidate and get a bodiless 304 when nothing changed.
+API_CACHE_CONTROL: Final = "max-age=2, must-revalidate"
+
+def _etag_response(request: Request, content) -> Response:
+    response = ORJSONResponse(jsonable_encoder(content), headers={"Cache-Control": API_CACHE_CONTROL})
+    etag = f'"{hashlib.blake2b(response.body, digest_size=8).hexdigest()}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
+    response.headers["ETag"] = etag
+    return response
+
+app = FastAPI(
+    title="Energy Monitor Dashboard Pro Web",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
-app = FastAPI(title="Energy Monitor Dashboard Pro Web", lifespan=lifespan)
+_INDEX_PATH: Final = os.path.join(os.path.dirname(__file__), "index.html")
+
+# no-cache: the page has to match this server's WebSocket message protocol
+# right after a deploy; revalidating is a 304 against the file's ETag.
+INDEX_CACHE_CONTROL: Final = "no-cache"
 
 @app.get("/")
-def get_index():
-    index_path = os.path.join(os.path.dirname(__file__), "index.html")
-    return FileResponse(index_path)
+async def get_index(request: Request):
+    response = FileResponse(_INDEX_PATH, stat_result=os.stat(_INDEX_PATH),
+                            headers={"Cache-Control": INDEX_CACHE_CONTROL})
+    etag = response.headers["etag"]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": INDEX_CACHE_CONTROL})
+    return response
 
 @app.get("/api/config")
-def get_config():
+async def get_config():
     return {
         "area_modes": {a: m.value for a, m in state.area_modes.items()},
         "interval_sec": state.interval_sec,
-        "areas": list(AREAS.keys()),
-        "modes": [m.value for m in SimMode]
+        "areas": AREA_NAMES,
+        "modes": [m.value for m in SimMode],
+        "broadcast_dropped": state.broadcast_dropped,
     }
 
 class ConfigUpdate(BaseModel):
@@ -755,7 +1107,7 @@ class ConfigUpdate(BaseModel):
     interval_sec: Optional[float] = None
 
 @app.post("/api/config")
-def update_config(config: ConfigUpdate):
+async def update_config(config: ConfigUpdate):
     if config.area_modes is not None:
         for a, m in config.area_modes.items():
             if a in state.area_modes or a == "all":
@@ -764,9 +1116,10 @@ def update_config(config: ConfigUpdate):
                         state.area_modes[k] = SimMode(m)
                 else:
                     state.area_modes[a] = SimMode(m)
+        state.refresh_flood_count()
     if config.interval_sec is not None:
         state.interval_sec = max(1.0, min(config.interval_sec, 60.0))
-    return {"status": "ok", "current": get_config()}
+    return {"status": "ok", "current": await get_config()}
 
 
 # ──────────────────────────────────────────────
@@ -778,41 +1131,60 @@ class RelayCommand(BaseModel):
     motivo: str = ""
     origen: str = "dashboard"
 
-@app.get("/api/relays")
-def get_relay_states():
-    """Get current state of all virtual relays."""
+def _relay_snapshot() -> Dict[str, dict]:
+    rs, rr, rc = state.relay_states, state.relay_reasons, state.relay_changed_by
     return {
         area: {
-            "estado": state.relay_states[area].value,
-            "motivo": state.relay_reasons.get(area, ""),
-            "cambiado_por": state.relay_changed_by.get(area, "sistema"),
+            "estado": rs[area].value,
+            "motivo": rr.get(area, ""),
+            "cambiado_por": rc.get(area, "sistema"),
         }
-        for area in AREAS
+        for area in AREA_NAMES
     }
 
+def _broadcast_relays():
+    """Push the relay snapshot to dashboards; call on the event loop."""
+    if manager.active_connections:
+        _enqueue_broadcast(orjson.dumps({"type": "relays", "relays": _relay_snapshot()}))
+
+@app.get("/api/relays")
+async def get_relay_states():
+    """Get current state of all virtual relays."""
+    return _relay_snapshot()
+
+def _publish_many(messages: List[tuple]):
+    """Publish (topic, payload) pairs; runs in the default executor."""
+    try:
+        for topic, payload in messages:
+            _mqtt_client_ref.publish(topic, payload, qos=QOS)
+    except Exception as exc:
+        log.warning("Relay command publish failed: %s", exc)
+
 @app.post("/api/relays")
-def control_relay(cmd: RelayCommand):
+async def control_relay(cmd: RelayCommand):
     """Control a virtual relay via REST API (also publishes MQTT command)."""
     if cmd.area != "all" and cmd.area not in AREAS:
         raise HTTPException(status_code=404, detail=f"Area '{cmd.area}' not found")
     
-    targets = list(AREAS.keys()) if cmd.area == "all" else [cmd.area]
-    new_state = RelayState.APAGADO if cmd.accion in ("cortar_energia", "apagar") else RelayState.ENCENDIDO
+    targets = AREA_NAMES if cmd.area == "all" else (cmd.area,)
+    new_state = RelayState.APAGADO if cmd.accion in RELAY_OFF_ACTIONS else RelayState.ENCENDIDO
     
-    for a in targets:
-        state.relay_states[a] = new_state
-        state.relay_reasons[a] = cmd.motivo
-        state.relay_changed_by[a] = cmd.origen
+    state.relay_states.update(dict.fromkeys(targets, new_state))
+    state.relay_reasons.update(dict.fromkeys(targets, cmd.motivo))
+    state.relay_changed_by.update(dict.fromkeys(targets, cmd.origen))
+    _broadcast_relays()
     
-    # Also publish via MQTT so the standalone simulator picks it up
+    # Also publish via MQTT so the standalone simulator picks it up. The
+    # publishes run off the event loop and the response doesn't wait on them.
     if _mqtt_client_ref:
-        mqtt_payload = json.dumps({
+        mqtt_payload = orjson.dumps({
             "accion": cmd.accion,
             "motivo": cmd.motivo,
             "origen": cmd.origen,
         })
-        for a in targets:
-            _mqtt_client_ref.publish(f"{TOPIC_PREFIX}/{a}/comando", mqtt_payload, qos=QOS)
+        asyncio.get_running_loop().run_in_executor(
+            None, _publish_many, [(f"{TOPIC_PREFIX}/{a}/comando", mqtt_payload) for a in targets]
+        )
     
     return {"status": "ok", "affected": targets, "new_state": new_state.value}
 
@@ -821,58 +1193,82 @@ def control_relay(cmd: RelayCommand):
 # Agent Status API  (reads from PostgreSQL — n8n agents)
 # ──────────────────────────────────────────────
 AGENT_NAMES = ["orchestrator", "diagnosis", "correlation", "maintenance", "resolution", "reports"]
+AGENT_STATS_REFRESH_SEC: Final = 30.0
+_AGENT_STATS_SQL: Final = "SELECT agent_name, decisions, last_active FROM mv_agent_stats"
 
-@app.get("/api/agents")
-def get_agent_status():
-    """Get live status and stats for all n8n-based agents from PostgreSQL."""
+def _refresh_agent_stats():
+    with _pg_conn() as conn, conn.cursor() as cur:
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_agent_stats")
+
+def _agent_stats(rows: List[dict]) -> Dict[str, dict]:
     stats: Dict[str, dict] = {
         name: {"decisions": 0, "last_active": None, "status": "idle"}
         for name in AGENT_NAMES
     }
+    for row in rows:
+        name = row["agent_name"]
+        if name in stats:
+            stats[name]["decisions"] = row["decisions"]
+            la = row["last_active"]
+            if isinstance(la, str):  # json_agg rows from /api/dashboard
+                la = datetime.fromisoformat(la)
+            stats[name]["last_active"] = la.isoformat() if la else None
+            # Consider "active" if last decision < 5 min ago
+            if la and (datetime.now(timezone.utc) - la).total_seconds() < 300:
+                stats[name]["status"] = "active"
+    return stats
+
+async def agent_stats_refresher():
+    """Keep mv_agent_stats current so /api/agents never aggregates on request,
+    and push each fresh snapshot to connected dashboards."""
+    while True:
+        await asyncio.sleep(AGENT_STATS_REFRESH_SEC)
+        try:
+            await asyncio.to_thread(_refresh_agent_stats)
+            _api_cache.pop("agents", None)
+            if manager.active_connections:
+                rows = await _cached_fetch("agents", _AGENT_STATS_SQL)
+                _enqueue_broadcast(orjson.dumps({"type": "agents", "agents": _agent_stats(rows)}))
+        except Exception as exc:
+            log.warning("Could not refresh mv_agent_stats: %s", exc)
+
+@app.get("/api/agents")
+async def get_agent_status(request: Request):
+    """Get live status and stats for all n8n-based agents from PostgreSQL."""
     try:
-        conn = _get_pg_conn()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
-            SELECT agent_name,
-                   COUNT(*)                      AS decisions,
-                   MAX(timestamp)                 AS last_active
-            FROM agent_decisions
-            GROUP BY agent_name
-        """)
-        for row in cur.fetchall():
-            name = row["agent_name"]
-            if name in stats:
-                stats[name]["decisions"] = row["decisions"]
-                la = row["last_active"]
-                stats[name]["last_active"] = la.isoformat() if la else None
-                # Consider "active" if last decision < 5 min ago
-                if la and (datetime.now(timezone.utc) - la).total_seconds() < 300:
-                    stats[name]["status"] = "active"
-        cur.close()
-        conn.close()
+        rows = await _cached_fetch("agents", _AGENT_STATS_SQL)
     except Exception as exc:
         log.warning("Could not query agent_decisions: %s", exc)
-    return stats
+        rows = []
+    return _etag_response(request, _agent_stats(rows))
+
+_http: Optional[httpx.AsyncClient] = None
+
+def _get_http() -> httpx.AsyncClient:
+    """Shared client for n8n webhooks, created on first use."""
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=5.0)
+    return _http
 
 @app.post("/api/agents/{agent_name}/trigger")
-def trigger_agent(agent_name: str):
+async def trigger_agent(agent_name: str):
     """Manually trigger an n8n agent via its webhook (for testing/demo)."""
     if agent_name not in AGENT_NAMES:
         raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
-    import urllib.request, urllib.error
     n8n_url = os.getenv("N8N_URL", "http://n8n:5678")
     url = f"{n8n_url}/webhook/agent-{agent_name}"
-    payload = json.dumps({
+    payload = orjson.dumps({
         "area": "laboratorio_computo",
         "kwh": 0,
         "ema": 0,
         "severidad": "Normal",
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "modo": "manual_trigger",
-    }).encode()
-    req = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/json"}, method="POST")
+    })
     try:
-        urllib.request.urlopen(req, timeout=5)
+        resp = await _get_http().post(url, content=payload, headers={"Content-Type": "application/json"})
+        resp.raise_for_status()
     except Exception as exc:
         log.warning("Agent trigger failed: %s", exc)
     return {"status": "triggered", "agent": agent_name}
@@ -884,12 +1280,87 @@ def trigger_agent(agent_name: str):
 class FeedbackInput(BaseModel):
     anomalia_id: Optional[int] = None
     incidente_id: Optional[int] = None
-    usuario: str = "operador"
-    tipo: str              # "resuelto" | "falso_positivo" | "correcto" | "incorrecto"
+    # Limits match the VARCHAR columns, so bad input is a 422 here, not a failed write
+    usuario: str = Field(default="operador", max_length=100)
+    tipo: str = Field(max_length=30)  # "resuelto" | "falso_positivo" | "correcto" | "incorrecto"
     comentario: str = ""
 
+# Feedback rows are queued and written by feedback_writer with one COPY per
+# burst: a single round-trip and commit instead of one INSERT per request.
+FEEDBACK_FLUSH_SEC: Final = 0.05
+FEEDBACK_RETRY_MAX_SEC: Final = 30.0
+# COPY text format: tab-separated, \N for NULL, backslash escapes
+_COPY_ESCAPES: Final = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+_feedback_queue: asyncio.Queue = asyncio.Queue()
+# Rows taken off the queue but not yet written; kept across failed attempts
+_feedback_pending: list = []
+
+def _drain_feedback(rows: list) -> list:
+    while True:
+        try:
+            rows.append(_feedback_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return rows
+
+# Errors that say nothing about the rows themselves: the whole burst is retried
+_PG_RETRYABLE: Final = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError)
+
+def _insert_feedback(rows: list):
+    """COPY the burst in one round-trip. One bad row aborts a COPY, so if the
+    server rejects it the rows are inserted one by one (each under a
+    savepoint) and only the ones that fail on their own are dropped."""
+    buf = io.StringIO("".join(
+        "\t".join("\\N" if v is None else str(v).translate(_COPY_ESCAPES) for v in row) + "\n"
+        for row in rows
+    ))
+    try:
+        with _pg_conn() as conn, conn.cursor() as cur:
+            cur.copy_expert(
+                "COPY feedback (anomalia_id, incidente_id, usuario, tipo, comentario) FROM STDIN", buf
+            )
+        return
+    except _PG_RETRYABLE:
+        raise
+    except psycopg2.Error as exc:
+        log.warning("Feedback COPY of %d rows rejected (%s); inserting row by row", len(rows), exc)
+    with _pg_conn() as conn, conn.cursor() as cur:
+        for row in rows:
+            cur.execute("SAVEPOINT feedback_row")
+            try:
+                cur.execute(
+                    "INSERT INTO feedback (anomalia_id, incidente_id, usuario, tipo, comentario) "
+                    "VALUES (%s, %s, %s, %s, %s)", row
+                )
+            except _PG_RETRYABLE:
+                raise
+            except psycopg2.Error as exc:
+                cur.execute("ROLLBACK TO SAVEPOINT feedback_row")
+                log.error("Dropping feedback row %r: %s", row, exc)
+            else:
+                cur.execute("RELEASE SAVEPOINT feedback_row")
+
+async def feedback_writer():
+    """Flush queued feedback every FEEDBACK_FLUSH_SEC. Requests were already
+    acknowledged, so a failed write keeps its rows and is retried with
+    exponential backoff (capped at FEEDBACK_RETRY_MAX_SEC)."""
+    delay = FEEDBACK_FLUSH_SEC
+    while True:
+        if not _feedback_pending:
+            _feedback_pending.append(await _feedback_queue.get())
+        await asyncio.sleep(delay)
+        _drain_feedback(_feedback_pending)
+        try:
+            await asyncio.to_thread(_insert_feedback, list(_feedback_pending))
+        except Exception as exc:
+            delay = min(delay * 2, FEEDBACK_RETRY_MAX_SEC)
+            log.warning("Could not persist %d feedback rows, retrying in %.1fs: %s",
+                        len(_feedback_pending), delay, exc)
+            continue
+        _feedback_pending.clear()
+        delay = FEEDBACK_FLUSH_SEC
+
 @app.post("/api/feedback")
-def submit_feedback(fb: FeedbackInput):
+async def submit_feedback(fb: FeedbackInput):
     """Submit operator feedback for an anomaly/incident."""
     entry = {
         "timestamp": datetime.now(timezone.utc).isoformat(),
@@ -899,35 +1370,20 @@ def submit_feedback(fb: FeedbackInput):
         "tipo": fb.tipo,
         "comentario": fb.comentario,
     }
-    # Persist to PostgreSQL
-    try:
-        conn = _get_pg_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO feedback (anomalia_id, incidente_id, usuario, tipo, comentario)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (fb.anomalia_id, fb.incidente_id, fb.usuario, fb.tipo, fb.comentario))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as exc:
-        log.warning("Could not persist feedback: %s", exc)
+    # Persist to PostgreSQL (batched by feedback_writer)
+    _feedback_queue.put_nowait((fb.anomalia_id, fb.incidente_id, fb.usuario, fb.tipo, fb.comentario))
     # Also keep in-memory for quick access
     state.feedback_log.append(entry)
     log.info("📝  Feedback received: %s for anomalia=%s", fb.tipo, fb.anomalia_id)
     return {"status": "ok", "feedback": entry}
 
 @app.get("/api/feedback")
-def get_feedback():
+async def get_feedback():
     """Get recent feedback entries from PostgreSQL."""
     try:
-        conn = _get_pg_conn()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM feedback ORDER BY timestamp DESC LIMIT 50")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return [dict(r) for r in rows]
+        return await asyncio.to_thread(
+            _fetch_dicts, "SELECT * FROM feedback ORDER BY timestamp DESC LIMIT 50"
+        )
     except Exception as exc:
         log.warning("Could not query feedback: %s", exc)
         return state.feedback_log
@@ -937,58 +1393,70 @@ def get_feedback():
 # Incidents & Maintenance API  (n8n agent data)
 # ──────────────────────────────────────────────
 @app.get("/api/incidents")
-def get_incidents():
+async def get_incidents(request: Request):
     """Get active and recent incidents managed by the resolution agent."""
     try:
-        conn = _get_pg_conn()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
+        rows = await _cached_fetch("incidents", """
             SELECT * FROM incidentes
-            ORDER BY inicio DESC LIMIT 20
+            ORDER BY timestamp_apertura DESC LIMIT 20
         """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return [dict(r) for r in rows]
     except Exception as exc:
         log.warning("Could not query incidentes: %s", exc)
-        return []
+        rows = []
+    return _etag_response(request, rows)
 
 @app.get("/api/maintenance")
-def get_maintenance():
+async def get_maintenance(request: Request):
     """Get pending maintenance recommendations from the maintenance agent."""
     try:
-        conn = _get_pg_conn()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
+        rows = await _cached_fetch("maintenance", """
             SELECT * FROM mantenimiento_preventivo
             ORDER BY timestamp DESC LIMIT 20
         """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return [dict(r) for r in rows]
     except Exception as exc:
         log.warning("Could not query mantenimiento_preventivo: %s", exc)
-        return []
+        rows = []
+    return _etag_response(request, rows)
 
 @app.get("/api/correlations")
-def get_correlations():
+async def get_correlations(request: Request):
     """Get recent cross-area correlation events."""
     try:
-        conn = _get_pg_conn()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("""
+        rows = await _cached_fetch("correlations", """
             SELECT * FROM correlaciones
             ORDER BY timestamp DESC LIMIT 20
         """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return [dict(r) for r in rows]
     except Exception as exc:
         log.warning("Could not query correlaciones: %s", exc)
-        return []
+        rows = []
+    return _etag_response(request, rows)
+
+
+# All dashboard widgets in one query: each list is aggregated server-side
+# into a JSON column, so the whole page costs a single round-trip.
+_DASHBOARD_SQL: Final = """
+    SELECT
+        (SELECT COALESCE(json_agg(t), '[]') FROM mv_agent_stats t) AS agents,
+        (SELECT COALESCE(json_agg(t), '[]') FROM (
+            SELECT * FROM incidentes ORDER BY timestamp_apertura DESC LIMIT 20) t) AS incidents,
+        (SELECT COALESCE(json_agg(t), '[]') FROM (
+            SELECT * FROM mantenimiento_preventivo ORDER BY timestamp DESC LIMIT 20) t) AS maintenance,
+        (SELECT COALESCE(json_agg(t), '[]') FROM (
+            SELECT * FROM correlaciones ORDER BY timestamp DESC LIMIT 20) t) AS correlations,
+        (SELECT COALESCE(json_agg(t), '[]') FROM (
+            SELECT * FROM feedback ORDER BY timestamp DESC LIMIT 50) t) AS feedback
+"""
+
+@app.get("/api/dashboard")
+async def get_dashboard(request: Request):
+    """Agents, incidents, maintenance, correlations and feedback in one response."""
+    try:
+        row = (await _cached_fetch("dashboard", _DASHBOARD_SQL))[0]
+    except Exception as exc:
+        log.warning("Could not query dashboard data: %s", exc)
+        row = {"agents": [], "incidents": [], "maintenance": [], "correlations": [],
+               "feedback": state.feedback_log}
+    return _etag_response(request, {**row, "agents": _agent_stats(row["agents"])})
 
 
 # ──────────────────────────────────────────────
@@ -1003,7 +1471,7 @@ def mqtt_publish(req: MqttPublishRequest):
     """Publish a message to MQTT via REST API (bridge for n8n)."""
     if not _mqtt_client_ref:
         raise HTTPException(status_code=503, detail="MQTT not connected")
-    _mqtt_client_ref.publish(req.topic, json.dumps(req.payload), qos=QOS)
+    _mqtt_client_ref.publish(req.topic, orjson.dumps(req.payload), qos=QOS)
     return {"status": "published", "topic": req.topic}
 
 @app.websocket("/ws")
@@ -1018,4 +1486,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop/httptools come with uvicorn[standard] (see requirements.txt).
+    # One worker on purpose: the simulation thread, relay/mode state, WebSocket
+    # clients and the fixed-id MQTT session all live in this process.
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", ws="websockets")
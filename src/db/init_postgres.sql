@@ -166,12 +166,26 @@ CREATE INDEX IF NOT EXISTS idx_agent_decisions_ts ON agent_decisions (timestamp
 CREATE INDEX IF NOT EXISTS idx_agent_decisions_agent ON agent_decisions (agent_name);
 CREATE INDEX IF NOT EXISTS idx_incidentes_estado ON incidentes (estado);
 CREATE INDEX IF NOT EXISTS idx_incidentes_area ON incidentes (area);
+CREATE INDEX IF NOT EXISTS idx_incidentes_apertura ON incidentes (timestamp_apertura DESC);
 CREATE INDEX IF NOT EXISTS idx_feedback_tipo ON feedback (tipo);
+CREATE INDEX IF NOT EXISTS idx_feedback_ts ON feedback (timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_correlaciones_ts ON correlaciones (timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_alert_history_hash ON alert_history (hash_contenido);
 CREATE INDEX IF NOT EXISTS idx_alert_history_area_ts ON alert_history (area, timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_mantenimiento_area ON mantenimiento_preventivo (area);
 CREATE INDEX IF NOT EXISTS idx_mantenimiento_estado ON mantenimiento_preventivo (estado);
+CREATE INDEX IF NOT EXISTS idx_mantenimiento_ts ON mantenimiento_preventivo (timestamp DESC);
+
+-- ============================================================
+--  Vistas materializadas (el dashboard las refresca cada 30 s)
+-- ============================================================
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_agent_stats AS
+    SELECT agent_name,
+           COUNT(*)       AS decisions,
+           MAX(timestamp) AS last_active
+    FROM agent_decisions
+    GROUP BY agent_name;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_agent_stats_agent ON mv_agent_stats (agent_name);
 
 -- Inicializar relés de todas las áreas como ENCENDIDO
 INSERT INTO relay_states (area, estado) VALUES
@@ -6,20 +6,24 @@ virtual relay actuators, realistic patterns, multiple failure modes,
 gradual anomalies, seasonal profiles, and structured logging.
 """
 
-import json
+import atexit
+import functools
 import logging
+import logging.handlers
 import math
 import os
-import random
+import queue
 import signal
+import socket
 import sys
 import time
-from dataclasses import dataclass, field, asdict
-from datetime import datetime, timezone
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Dict, Final, List, Optional
 
 from dotenv import load_dotenv
+import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
 
 from fastapi import FastAPI, HTTPException
@@ -33,15 +37,24 @@ load_dotenv()
 # ──────────────────────────────────────────────
 # Logging setup
 # ──────────────────────────────────────────────
+# Records are formatted by the QueueHandler and written to stdout and the log
+# file by a listener thread, so console/disk I/O never blocks publishing.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.StreamHandler(sys.stdout),
+    logging.FileHandler("simulator.log", encoding="utf-8"),
+)
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(name)s — %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
     handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("simulator.log", encoding="utf-8"),
+        logging.handlers.QueueHandler(_log_queue),
     ],
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 log = logging.getLogger("EnergySimPro")
 
 
@@ -72,7 +85,7 @@ class RelayState(str, Enum):
 # ──────────────────────────────────────────────
 # Dataclasses
 # ──────────────────────────────────────────────
-@dataclass
+@dataclass(slots=True)
 class AreaProfile:
     base: float                 # kWh diurno base
     nocturno: float             # kWh nocturno base
@@ -83,7 +96,7 @@ class AreaProfile:
     floor: int = 1              # piso (metadata)
 
 
-@dataclass
+@dataclass(slots=True)
 class SensorReading:
     area: str
     kwh: float
@@ -100,49 +113,94 @@ class SensorReading:
     floor: int
     sequence: int               # número de lectura para detectar gaps
     relay_state: str = "ENCENDIDO"  # estado del relé virtual
+    drift_factor: float = 1.0       # multiplicador acumulado en GRADUAL_DRIFT
     tags: List[str] = field(default_factory=list)
 
     def to_dict(self) -> dict:
-        return asdict(self)
+        # Shallow copy — asdict() deep-copies recursively per call.
+        # Publishing goes through SensorSimulator.encode, not this.
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+@dataclass(frozen=True)
+class TickContext:
+    """Clock values shared by every reading in one batch."""
+    timestamp: str              # UTC ISO-8601, used for readings and summary
+    hour: int                   # hora local (curvas diarias)
+    hour_frac: float            # hour + minute/60
+    month: int
+    night: bool
+    day_curve: float            # sin(pi*(hour-6)/12), ciclo diario de temp/humedad
+
+    @classmethod
+    def now(cls) -> "TickContext":
+        t = time.time()
+        local = time.localtime(t)
+        hour = local.tm_hour
+        return cls(
+            timestamp=_iso_utc(t),
+            hour=hour,
+            hour_frac=hour + local.tm_min / 60.0,
+            month=local.tm_mon,
+            night=_is_night(hour),
+            day_curve=math.sin(math.pi * (hour - 6) / 12),
+        )
 
 
 # ──────────────────────────────────────────────
 # Virtual Relay Manager — Actuadores Virtuales
 # ──────────────────────────────────────────────
 class RelayManager:
-    """Manages virtual relay (breaker) states per area."""
+    """Manages virtual relay (breaker) states per area.
+    States live in a bytearray (1 = ENCENDIDO, 0 = APAGADO) indexed by the
+    area's position, so the per-reading is_on() check is one byte read."""
     
     def __init__(self, areas: List[str]):
-        self._states: Dict[str, RelayState] = {a: RelayState.ENCENDIDO for a in areas}
+        self._index: Dict[str, int] = {a: i for i, a in enumerate(areas)}
+        self._states = bytearray(b"\x01" * len(areas))
         self._last_changed: Dict[str, str] = {}
         self._change_reasons: Dict[str, str] = {}
+        # get_all_states()/states_json() snapshots, dropped on every set_state
+        self._snapshot: Optional[Dict[str, dict]] = None
+        self._snapshot_json: Optional[bytes] = None
     
     def get_state(self, area: str) -> RelayState:
-        return self._states.get(area, RelayState.ENCENDIDO)
+        return RelayState.ENCENDIDO if self.is_on(area) else RelayState.APAGADO
     
     def set_state(self, area: str, state: RelayState, reason: str = "") -> bool:
-        if area not in self._states:
+        i = self._index.get(area)
+        if i is None:
             log.warning("Relay: unknown area '%s'", area)
             return False
-        old = self._states[area]
-        self._states[area] = state
-        self._last_changed[area] = datetime.now(timezone.utc).isoformat()
+        old = RelayState.ENCENDIDO if self._states[i] else RelayState.APAGADO
+        self._states[i] = state is RelayState.ENCENDIDO
+        self._last_changed[area] = _iso_utc(time.time())
         self._change_reasons[area] = reason
+        self._snapshot = self._snapshot_json = None
         log.info("⚡ RELAY [%s] %s → %s | Motivo: %s", area, old.value, state.value, reason)
         return True
     
     def is_on(self, area: str) -> bool:
-        return self.get_state(area) == RelayState.ENCENDIDO
+        i = self._index.get(area)
+        return i is None or self._states[i] != 0
     
     def get_all_states(self) -> Dict[str, dict]:
-        return {
-            area: {
-                "estado": self._states[area].value,
-                "ultimo_cambio": self._last_changed.get(area, ""),
-                "motivo": self._change_reasons.get(area, ""),
+        """Shared snapshot, rebuilt only after a state change — do not mutate."""
+        if self._snapshot is None:
+            self._snapshot = {
+                area: {
+                    "estado": (RelayState.ENCENDIDO if self._states[i] else RelayState.APAGADO).value,
+                    "ultimo_cambio": self._last_changed.get(area, ""),
+                    "motivo": self._change_reasons.get(area, ""),
+                }
+                for area, i in self._index.items()
             }
-            for area in self._states
-        }
+        return self._snapshot
+    
+    def states_json(self) -> bytes:
+        if self._snapshot_json is None:
+            self._snapshot_json = orjson.dumps(self.get_all_states())
+        return self._snapshot_json
 
 
 # ──────────────────────────────────────────────
@@ -161,6 +219,13 @@ AREAS: Final[Dict[str, AreaProfile]] = {
     "laboratorio_quimica": AreaProfile(base=7.8,  nocturno=2.1,  std_pct=0.10, peak_hour=13, peak_factor=1.25, devices=22, floor=3),
 }
 
+# Per-area constants as parallel arrays (same order as AREAS) so the
+# time-of-day curve is evaluated for every area in one NumPy expression.
+_BASE_ARR:        Final[np.ndarray] = np.array([p.base for p in AREAS.values()])
+_NOCT_ARR:        Final[np.ndarray] = np.array([p.nocturno for p in AREAS.values()])
+_PEAK_HOUR_ARR:   Final[np.ndarray] = np.array([p.peak_hour for p in AREAS.values()], dtype=float)
+_PEAK_FACTOR_ARR: Final[np.ndarray] = np.array([p.peak_factor for p in AREAS.values()])
+
 # ──────────────────────────────────────────────
 # Environment
 # ──────────────────────────────────────────────
@@ -172,61 +237,123 @@ MODE:          Final[SimMode]  = SimMode(os.getenv("SIM_MODE", "normal"))
 ANOMALY_AREA:  Final[str]      = os.getenv("ANOMALY_AREA", "auditorio")
 INTERVAL_SEC:  Final[float]    = float(os.getenv("SIM_INTERVAL", "30"))
 QOS:           Final[int]      = int(os.getenv("MQTT_QOS", "1"))   # 0 | 1 | 2
+# Per-area readings are superseded every cycle, so by default they skip the
+# PUBACK round-trip (QoS 0). Summary, status, LWT and relay ACKs use QOS.
+TELEMETRY_QOS: Final[int]      = int(os.getenv("MQTT_TELEMETRY_QOS", "0"))
+BATCH_SAMPLES: Final[int]      = 10 if MODE == SimMode.FLOOD else 1   # lecturas por área y ciclo
 TOPIC_PREFIX:  Final[str]      = os.getenv("TOPIC_PREFIX", "edificio")
 BUILDING_ID:   Final[str]      = os.getenv("BUILDING_ID", "edificio_principal")
+FLOOD_CLIENTS: Final[int]      = int(os.getenv("SIM_FLOOD_CLIENTS", "4"))  # conexiones en modo FLOOD
+
+SENSOR_IDS: Final[Dict[str, str]] = {a: f"{BUILDING_ID}_{a}_s{p.floor:02d}" for a, p in AREAS.items()}
+TOPICS:     Final[Dict[str, str]] = {a: f"{TOPIC_PREFIX}/{a}/consumo" for a in AREAS}
+META_TOPICS: Final[Dict[str, str]] = {a: f"{TOPIC_PREFIX}/{a}/meta" for a in AREAS}
+STATUS_TOPIC:  Final[str] = f"{TOPIC_PREFIX}/system/status"
+SUMMARY_TOPIC: Final[str] = f"{TOPIC_PREFIX}/summary"
+# Command topics: {prefix}/{area}/comando and {prefix}/system/comando
+_CMD_PREFIX: Final[str] = f"{TOPIC_PREFIX}/"
+_CMD_SUFFIX: Final[str] = "/comando"
+_SYSTEM_CMD: Final[str] = f"{TOPIC_PREFIX}/system/comando"
+
+
+def _json_template(fixed: dict, dynamic: str) -> bytes:
+    """orjson-encode the constant fields once and leave `dynamic` (raw
+    `%`-placeholders, without braces) to be filled per message."""
+    head = orjson.dumps(fixed)[:-1].replace(b"%", b"%%")
+    return head + b"," + dynamic.encode() + b"}"
+
+
+# Fixed-schema messages: only the placeholders change between publishes.
+_SUMMARY_TMPL: Final[bytes] = _json_template(
+    {"building_id": BUILDING_ID, "areas_total": len(AREAS),
+     "samples": BATCH_SAMPLES, "mode": MODE.value},
+    '"total_kwh":%.4f,"areas_reporting":%d,"timestamp":"%b"',
+)
+_ONLINE_TMPL:  Final[bytes] = _json_template(
+    {"status": "online", "building": BUILDING_ID, "mode": MODE.value}, '"ts":"%b"')
+_OFFLINE_TMPL: Final[bytes] = _json_template(
+    {"status": "offline", "building": BUILDING_ID}, '"ts":"%b"')
+_RELAY_STATUS_TMPL: Final[bytes] = b'{"relay_states":%b,"ts":"%b"}'
+
+
+# Static per-area metadata, published retained on connect instead of being
+# repeated in every reading.
+_META_PAYLOADS: Final[Dict[str, bytes]] = {
+    a: orjson.dumps({"area": a, "building_id": BUILDING_ID, "sensor_id": SENSOR_IDS[a],
+                     "floor": p.floor, "device_count": p.devices})
+    for a, p in AREAS.items()
+}
+
+
+def _iso_utc(t: float) -> str:
+    """UTC ISO-8601 for a time.time() value, without building a datetime."""
+    g = time.gmtime(t)
+    return "%04d-%02d-%02dT%02d:%02d:%02d.%06d+00:00" % (
+        g.tm_year, g.tm_mon, g.tm_mday, g.tm_hour, g.tm_min, g.tm_sec, int(t % 1 * 1e6))
+
+
+def _utc_now_b() -> bytes:
+    return _iso_utc(time.time()).encode()
 
 
 # ──────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────
-def _gaussian_noise(mean: float, std_pct: float) -> float:
-    """Returns mean * gaussian_factor (more realistic than uniform)."""
-    factor = random.gauss(1.0, std_pct)
+# One generator for the publisher; draws are batched per cycle in publish_batch.
+_rng: Final[np.random.Generator] = np.random.default_rng()
+
+
+def _gaussian_noise(mean: float, std_pct: float, z: float) -> float:
+    """Returns mean * gaussian_factor (more realistic than uniform).
+    `z` is a pre-drawn standard normal sample."""
+    factor = 1.0 + std_pct * z
     return max(0.01, mean * factor)
 
 
-def _seasonal_factor() -> float:
+# Verano (Dec-Mar) +5%, Invierno (Jun-Sep) -3%; indexed by month (index 0 unused)
+_SEASONAL: Final[tuple] = (1.0, 1.05, 1.04, 1.02, 1.00, 0.99, 0.97, 0.96, 0.97, 0.98, 1.00, 1.02, 1.05)
+_NIGHT:    Final[tuple] = tuple(h < 6 or h >= 22 for h in range(24))
+
+
+def _seasonal_factor(month: int) -> float:
     """Slight seasonal adjustment based on month (Peru climate)."""
-    month = datetime.now().month
-    # Verano (Dec-Mar) +5%, Invierno (Jun-Sep) -3%
-    seasonal = {12: 1.05, 1: 1.05, 2: 1.04, 3: 1.02,
-                4: 1.00, 5: 0.99, 6: 0.97, 7: 0.96,
-                8: 0.97, 9: 0.98, 10: 1.00, 11: 1.02}
-    return seasonal.get(month, 1.0)
+    return _SEASONAL[month]
 
 
-def _hourly_factor(profile: AreaProfile) -> float:
-    """Smooth sinusoidal curve peaking at profile.peak_hour."""
-    hour = datetime.now().hour + datetime.now().minute / 60.0
-    # Gaussian bell centered at peak_hour, width ~3h
-    distance = abs(hour - profile.peak_hour)
-    if distance > 12:
-        distance = 24 - distance
-    bell = math.exp(-0.5 * (distance / 3.0) ** 2)
-    return 1.0 + (profile.peak_factor - 1.0) * bell
+@functools.lru_cache(maxsize=4)
+def _base_kwh_vector(night: bool, month: int, hour_frac: float) -> tuple:
+    """Baseline kWh for every area (AREAS order) with time-of-day + seasonal factors.
+    Memoized: the inputs (TickContext fields) only change once a minute."""
+    base = _NOCT_ARR if night else _BASE_ARR
+    # Gaussian bell centered at each peak_hour, width ~3h
+    distance = np.abs(hour_frac - _PEAK_HOUR_ARR)
+    distance = np.minimum(distance, 24 - distance)
+    bell = np.exp(-0.5 * (distance / 3.0) ** 2)
+    hourly = 1.0 + (_PEAK_FACTOR_ARR - 1.0) * bell
+    return tuple((base * hourly * _seasonal_factor(month)).tolist())
 
 
-def _is_night() -> bool:
-    h = datetime.now().hour
-    return h < 6 or h >= 22
+def _is_night(hour: int) -> bool:
+    return _NIGHT[hour]
 
 
-def _simulate_env() -> tuple[float, float]:
-    """Returns (temperature_c, humidity_pct) with realistic daily cycle."""
-    hour = datetime.now().hour
+def _simulate_env(day_curve: float, z_temp: float, z_hum: float) -> tuple[float, float]:
+    """Returns (temperature_c, humidity_pct) with realistic daily cycle.
+    `day_curve` is TickContext.day_curve."""
     # Temperatura: 18°C nocturno → 28°C mediodía
-    temp = 18 + 10 * math.sin(math.pi * (hour - 6) / 12) + random.gauss(0, 0.5)
+    temp = 18 + 10 * day_curve + 0.5 * z_temp
     temp = round(max(15.0, min(35.0, temp)), 1)
     # Humedad: 40% mediodía → 75% nocturno
-    hum = 75 - 35 * math.sin(math.pi * (hour - 6) / 12) + random.gauss(0, 1.5)
+    hum = 75 - 35 * day_curve + 1.5 * z_hum
     hum = round(max(20.0, min(95.0, hum)), 1)
     return temp, hum
 
 
-def _simulate_electrical(kwh: float) -> tuple[float, float, float]:
-    """Returns (voltage_v, current_a, power_factor) from kWh."""
-    voltage = round(random.gauss(220.0, 2.0), 1)
-    pf = round(random.uniform(0.85, 0.98), 3)
+def _simulate_electrical(kwh: float, z_volt: float, pf: float) -> tuple[float, float, float]:
+    """Returns (voltage_v, current_a, power_factor) from kWh.
+    `z_volt` is a standard normal sample, `pf` a U(0.85, 0.98) sample."""
+    voltage = round(220.0 + 2.0 * z_volt, 1)
+    pf = round(pf, 3)
     # P = V * I * PF  →  I = P / (V * PF)  (kWh como proxy de kW instantáneo)
     current = round((kwh * 1000) / (voltage * pf), 2)
     return voltage, current, pf
@@ -235,71 +362,118 @@ def _simulate_electrical(kwh: float) -> tuple[float, float, float]:
 # ──────────────────────────────────────────────
 # Reading generator
 # ──────────────────────────────────────────────
+# SensorSimulator method generating ANOMALY_AREA's readings for each mode
+# (NORMAL and FLOOD use _read_normal).
+_MODE_READERS: Final[Dict[SimMode, str]] = {
+    SimMode.SENSOR_FAILURE: "_read_sensor_failure",
+    SimMode.INTERMITTENT:   "_read_intermittent",
+    SimMode.GRADUAL_DRIFT:  "_read_gradual_drift",
+    SimMode.ANOMALY:        "_read_spike",
+    SimMode.NIGHT_ANOMALY:  "_read_night_anomaly",
+}
+
+
 class SensorSimulator:
     def __init__(self) -> None:
         self._drift: Dict[str, float] = {a: 1.0 for a in AREAS}
         self._seq:   Dict[str, int]   = {a: 0   for a in AREAS}
         self._intermittent_skip: Dict[str, bool] = {}
+        self._anomaly_read = getattr(self, _MODE_READERS.get(MODE, "_read_normal"))
+        # drift_factor is only meaningful (and only sent) under GRADUAL_DRIFT
+        self._send_drift = MODE == SimMode.GRADUAL_DRIFT
+        # Constant head of each area's JSON payload, encoded once (see encode)
+        self._prefix: Dict[str, bytes] = {
+            a: orjson.dumps({"area": a})[:-1] + b"," for a in AREAS
+        }
+        # Relay-off readings are all zeros: only timestamp and sequence vary
+        self._relay_off: Dict[str, bytes] = {
+            a: p.replace(b"%", b"%%") + (
+                b'"kwh":0.0,"timestamp":"%b","modo":"relay_off","voltage":0.0,'
+                b'"current":0.0,"power_factor":0.0,"temperature_c":0.0,'
+                b'"humidity_pct":0.0,"quality":"relay_off","sequence":%d,'
+                b'"relay_state":"APAGADO","tags":["relay_off"]}'
+            )
+            for a, p in self._prefix.items()
+        }
 
-    def _base_kwh(self, area: str, profile: AreaProfile) -> float:
-        """Returns baseline kWh with time-of-day + seasonal factors."""
-        base = profile.nocturno if _is_night() else profile.base
-        return base * _hourly_factor(profile) * _seasonal_factor()
-
-    def get_reading(self, area: str, profile: AreaProfile) -> Optional[SensorReading]:
+    # ── Per-mode kWh generators ─────────────
+    # Each returns (kwh, quality), or None to drop the reading. MODE is fixed
+    # for the process, so the one for ANOMALY_AREA is picked in __init__.
+    def _read_normal(self, area: str, profile: AreaProfile, ctx: TickContext,
+                     base: float, z: float, tags: List[str]) -> Optional[tuple[float, str]]:
+        return round(_gaussian_noise(base, profile.std_pct, z), 4), "ok"
+
+    def _read_sensor_failure(self, area, profile, ctx, base, z, tags):
+        log.warning("[SENSOR_FAILURE] Dropping reading for %s", area)
+        return None
+
+    def _read_intermittent(self, area, profile, ctx, base, z, tags):
+        skip = self._intermittent_skip.get(area, False)
+        self._intermittent_skip[area] = not skip
+        if skip:
+            log.warning("[INTERMITTENT] Skipping reading for %s", area)
+            return None
+        tags.append("intermittent_recovery")
+        return self._read_normal(area, profile, ctx, base, z, tags)
+
+    def _read_gradual_drift(self, area, profile, ctx, base, z, tags):
+        self._drift[area] = min(round(self._drift[area] + 0.02, 2), 3.0)
+        kwh = round(_gaussian_noise(base * self._drift[area], profile.std_pct, z), 4)
+        return kwh, "degraded" if self._drift[area] > 1.5 else "ok"
+
+    def _read_spike(self, area, profile, ctx, base, z, tags):
+        tags.append("spike_anomaly")
+        return round(_gaussian_noise(base * 2.8, 0.05, z), 4), "degraded"
+
+    def _read_night_anomaly(self, area, profile, ctx, base, z, tags):
+        if not ctx.night:
+            return self._read_normal(area, profile, ctx, base, z, tags)
+        tags.append("night_spike")
+        return round(_gaussian_noise(base * 3.5, 0.05, z), 4), "degraded"
+
+    def encode(self, r: SensorReading) -> bytes:
+        """JSON payload for a reading: cached per-area prefix + per-cycle fields.
+        sensor_id, floor and device_count live on the retained meta topic."""
+        tail = (
+            f'"kwh":{r.kwh},"timestamp":"{r.timestamp}",'
+            f'"modo":"{r.modo}","voltage":{r.voltage},"current":{r.current},'
+            f'"power_factor":{r.power_factor},"temperature_c":{r.temperature_c},'
+            f'"humidity_pct":{r.humidity_pct},"quality":"{r.quality}",'
+            f'"sequence":{r.sequence},'
+            f'"relay_state":"{r.relay_state}",'
+        )
+        if self._send_drift:
+            tail += f'"drift_factor":{r.drift_factor},'
+        tail += '"tags":'
+        return self._prefix[r.area] + tail.encode() + orjson.dumps(r.tags) + b"}"
+
+    def encode_relay_off(self, area: str, timestamp: bytes) -> bytes:
+        """Same payload as encode() of a zeroed relay_off reading, without
+        drift_factor (a relay that is off has nothing to drift)."""
+        return self._relay_off[area] % (timestamp, self._seq[area])
+
+    def get_reading(self, area: str, profile: AreaProfile, ctx: TickContext,
+                    base: float, z: List[float], pf: float) -> Optional[SensorReading]:
+        """`base` is this area's entry from _base_kwh_vector; `z`
+        (kwh, temp, hum, voltage) and `pf` are its row of the cycle's RNG draw."""
         self._seq[area] += 1
-        now_utc = datetime.now(timezone.utc).isoformat()
-        temp, hum = _simulate_env()
+        temp, hum = _simulate_env(ctx.day_curve, z[1], z[2])
         tags: List[str] = []
 
-        # ── Mode: sensor failure ────────────────
-        if MODE == SimMode.SENSOR_FAILURE and area == ANOMALY_AREA:
-            log.warning("[SENSOR_FAILURE] Dropping reading for %s", area)
+        read = self._anomaly_read if area == ANOMALY_AREA else self._read_normal
+        result = read(area, profile, ctx, base, z[0], tags)
+        if result is None:
             return None
+        kwh, quality = result
 
-        # ── Mode: intermittent ──────────────────
-        if MODE == SimMode.INTERMITTENT and area == ANOMALY_AREA:
-            skip = self._intermittent_skip.get(area, False)
-            self._intermittent_skip[area] = not skip
-            if skip:
-                log.warning("[INTERMITTENT] Skipping reading for %s", area)
-                return None
-            tags.append("intermittent_recovery")
-
-        base = self._base_kwh(area, profile)
-
-        # ── Mode: gradual drift ─────────────────
-        if MODE == SimMode.GRADUAL_DRIFT and area == ANOMALY_AREA:
-            self._drift[area] = min(self._drift[area] + 0.02, 3.0)
-            kwh = round(_gaussian_noise(base * self._drift[area], profile.std_pct), 4)
-            tags.append(f"drift_factor:{self._drift[area]:.2f}")
-            quality = "degraded" if self._drift[area] > 1.5 else "ok"
-
-        # ── Mode: anomaly (spike) ───────────────
-        elif MODE == SimMode.ANOMALY and area == ANOMALY_AREA:
-            kwh = round(_gaussian_noise(base * 2.8, 0.05), 4)
-            tags.append("spike_anomaly")
-            quality = "degraded"
-
-        # ── Mode: night anomaly ─────────────────
-        elif MODE == SimMode.NIGHT_ANOMALY and area == ANOMALY_AREA and _is_night():
-            kwh = round(_gaussian_noise(base * 3.5, 0.05), 4)
-            tags.append("night_spike")
-            quality = "degraded"
-
-        # ── Normal reading ──────────────────────
-        else:
-            kwh = round(_gaussian_noise(base, profile.std_pct), 4)
-            quality = "ok"
-
-        voltage, current, pf = _simulate_electrical(kwh)
+        voltage, current, pf = _simulate_electrical(kwh, z[3], pf)
 
         return SensorReading(
             area=area,
             kwh=kwh,
-            timestamp=now_utc,
+            timestamp=ctx.timestamp,
             modo=MODE.value,
-            sensor_id=f"{BUILDING_ID}_{area}_s{profile.floor:02d}",
+            sensor_id=SENSOR_IDS[area],
             voltage=voltage,
             current=current,
             power_factor=pf,
@@ -309,6 +483,7 @@ class SensorSimulator:
             device_count=profile.devices,
             floor=profile.floor,
             sequence=self._seq[area],
+            drift_factor=self._drift[area],
             tags=tags,
         )
 
@@ -327,36 +502,41 @@ def _on_connect(client, userdata, flags, reason_code, properties):
         log.info("✅  Connected to MQTT broker %s:%s", BROKER, PORT)
         # Publish a "system online" event
         client.publish(
-            f"{TOPIC_PREFIX}/system/status",
-            json.dumps({"status": "online", "building": BUILDING_ID,
-                        "mode": MODE.value, "ts": datetime.now(timezone.utc).isoformat()}),
+            STATUS_TOPIC,
+            _ONLINE_TMPL % _utc_now_b(),
             qos=QOS,
             retain=True,
         )
+        _publish_area_meta(client)
         # ── Subscribe to control topics (bidirectional) ──
         control_topic = f"{TOPIC_PREFIX}/+/comando"
         client.subscribe(control_topic, qos=QOS)
         log.info("📡  Subscribed to control topic: %s", control_topic)
         
         # Subscribe to system-wide commands
-        system_topic = f"{TOPIC_PREFIX}/system/comando"
-        client.subscribe(system_topic, qos=QOS)
-        log.info("📡  Subscribed to system topic: %s", system_topic)
+        client.subscribe(_SYSTEM_CMD, qos=QOS)
+        log.info("📡  Subscribed to system topic: %s", _SYSTEM_CMD)
     else:
         log.error("❌  Connection failed with code %s", reason_code)
 
 
+def _publish_area_meta(client: mqtt.Client) -> None:
+    for area, payload in _META_PAYLOADS.items():
+        client.publish(META_TOPICS[area], payload, qos=QOS, retain=True)
+
+
 def _on_message(client, userdata, msg):
     """Process incoming control commands from n8n/Telegram/agents."""
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode("utf-8"))
+        payload = orjson.loads(msg.payload)
         log.info("📨  Command received on %s: %s", topic, payload)
         
         # Parse area from topic: edificio/{area}/comando
-        parts = topic.split("/")
-        if len(parts) >= 3 and parts[-1] == "comando":
-            area = parts[1] if parts[1] != "system" else None
+        if topic == _SYSTEM_CMD:
+            area = None
+        elif topic.startswith(_CMD_PREFIX) and topic.endswith(_CMD_SUFFIX):
+            area = topic[len(_CMD_PREFIX):-len(_CMD_SUFFIX)]
         else:
             log.warning("Unknown command topic format: %s", topic)
             return
@@ -387,17 +567,16 @@ def _on_message(client, userdata, msg):
         
         elif accion == "status_rele":
             # Publish current relay states
-            states = relay_mgr.get_all_states()
             client.publish(
                 f"{TOPIC_PREFIX}/system/relay_status",
-                json.dumps({"relay_states": states, "ts": datetime.now(timezone.utc).isoformat()}),
+                _RELAY_STATUS_TMPL % (relay_mgr.states_json(), _iso_utc(time.time()).encode()),
                 qos=QOS,
             )
         
         else:
             log.warning("Unknown command action: %s", accion)
             
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         log.error("Invalid JSON in command: %s", msg.payload)
     except Exception as e:
         log.error("Error processing command: %s", e)
@@ -410,86 +589,105 @@ def _publish_relay_ack(client: mqtt.Client, area: str, new_state: str, motivo: s
         "relay_state": new_state,
         "motivo": motivo,
         "origen": origen,
-        "ts": datetime.now(timezone.utc).isoformat(),
+        "ts": _iso_utc(time.time()),
     }
-    client.publish(f"{TOPIC_PREFIX}/system/relay_ack", json.dumps(ack), qos=QOS)
+    client.publish(f"{TOPIC_PREFIX}/system/relay_ack", orjson.dumps(ack), qos=QOS)
     log.info("✅  Relay ACK published for %s → %s", area, new_state)
 
 
+def _on_socket_open(client, userdata, sock):
+    """Tune the broker socket before CONNECT: small bursty publishes should
+    not sit behind Nagle's algorithm, and a FLOOD burst should fit the buffer."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 256 * 1024)
+    except (OSError, AttributeError) as e:  # p.ej. transporte websockets
+        log.debug("Socket tuning skipped: %s", e)
+
+
 def _on_disconnect(client, userdata, flags, reason_code, properties):
     if reason_code != 0:
         log.warning("⚠️  Unexpected disconnect (code=%s). Will retry…", reason_code)
 
 
+# Delivery counters, one dict per client (its userdata) so each is only
+# written by that client's network thread. Publishes are never awaited (no
+# wait_for_publish); failures are surfaced here instead. "sent" is not a
+# broker ack: paho reports QoS 0 (the telemetry default) once it is written.
+_publish_stats: List[Dict[str, int]] = []
+
+
 def _on_publish(client, userdata, mid, reason_code, properties):
-    pass  # Silence ACK noise; remove `pass` and add log.debug if needed
+    if reason_code.is_failure:
+        userdata["failed"] += 1
+        log.warning("Publish mid=%s rejected by broker: %s", mid, reason_code)
+    else:
+        userdata["sent"] += 1
+
+
+def _publish_totals() -> tuple[int, int]:
+    return (sum(st["sent"] for st in _publish_stats),
+            sum(st["failed"] for st in _publish_stats))
 
 
 # ──────────────────────────────────────────────
 # Publisher
 # ──────────────────────────────────────────────
-def publish_batch(client: mqtt.Client, sim: SensorSimulator) -> None:
-    """Publishes one reading per area. In FLOOD mode, sends 10x.
-    Respects relay states — areas with APAGADO relay produce zero readings."""
-    iterations = 10 if MODE == SimMode.FLOOD else 1
+def publish_batch(client: mqtt.Client, sim: SensorSimulator,
+                  shards: Optional[List[mqtt.Client]] = None) -> None:
+    """Publishes one reading per area. In FLOOD mode, samples 10x and sends
+    each area's samples as one JSON array on its usual topic.
+    Respects relay states — areas with APAGADO relay produce zero readings.
+    Readings are spread over `shards` by area (so each area keeps its order);
+    the summary always goes through `client`."""
+    iterations = BATCH_SAMPLES
+    pubs = shards or [client]
+    pending: Dict[str, List[bytes]] = {area: [] for area in AREAS}
+    total_kwh = 0.0
 
     for _ in range(iterations):
-        total_kwh = 0.0
-        published = 0
+        ctx = TickContext.now()
+        base_kwh = _base_kwh_vector(ctx.night, ctx.month, ctx.hour_frac)
+        noise = _rng.standard_normal((len(AREAS), 4)).tolist()
+        pfs = _rng.uniform(0.85, 0.98, len(AREAS)).tolist()
 
-        for area, profile in AREAS.items():
+        ts = ctx.timestamp.encode()
+        for i, (area, profile) in enumerate(AREAS.items()):
             # ── Check relay state ──
             if not relay_mgr.is_on(area):
                 # Relay is OFF: produce a zero reading
-                now_utc = datetime.now(timezone.utc).isoformat()
-                reading = SensorReading(
-                    area=area, kwh=0.0, timestamp=now_utc,
-                    modo="relay_off", sensor_id=f"{BUILDING_ID}_{area}_s{profile.floor:02d}",
-                    voltage=0.0, current=0.0, power_factor=0.0,
-                    temperature_c=0.0, humidity_pct=0.0, quality="relay_off",
-                    device_count=0, floor=profile.floor,
-                    sequence=sim._seq.get(area, 0),
-                    relay_state=RelayState.APAGADO.value,
-                    tags=["relay_off"],
-                )
-                topic = f"{TOPIC_PREFIX}/{area}/consumo"
-                payload = json.dumps(reading.to_dict())
-                client.publish(topic, payload, qos=QOS)
-                published += 1
-                log.info("[RELAY_OFF] %-25s  0.0000 kWh  (relay apagado)", area)
-                continue
-            
-            reading = sim.get_reading(area, profile)
-            if reading is None:
+                pending[area].append(sim.encode_relay_off(area, ts))
+                log.debug("[RELAY_OFF] %-25s  0.0000 kWh  (relay apagado)", area)
                 continue
 
-            topic = f"{TOPIC_PREFIX}/{area}/consumo"
-            payload = json.dumps(reading.to_dict())
-
-            result = client.publish(topic, payload, qos=QOS)
-            if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                log.error("Publish error on %s: %s", topic, result.rc)
+            reading = sim.get_reading(area, profile, ctx, base_kwh[i], noise[i], pfs[i])
+            if reading is None:
                 continue
 
+            pending[area].append(sim.encode(reading))
             total_kwh += reading.kwh
-            published += 1
-            log.info("[%s] %-25s %.4f kWh  |  V:%.1f  I:%.2fA  PF:%.3f  Q:%s",
+            log.debug("[%s] %-25s %.4f kWh  |  V:%.1f  I:%.2fA  PF:%.3f  Q:%s",
                      MODE.value, area, reading.kwh,
                      reading.voltage, reading.current,
                      reading.power_factor, reading.quality)
 
-        # Summary message per batch
-        summary = {
-            "building_id": BUILDING_ID,
-            "total_kwh": round(total_kwh, 4),
-            "areas_reporting": published,
-            "areas_total": len(AREAS),
-            "mode": MODE.value,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-        }
-        client.publish(f"{TOPIC_PREFIX}/summary", json.dumps(summary), qos=QOS)
-        log.info("📊  Batch summary — Total: %.4f kWh | %d/%d areas",
-                 total_kwh, published, len(AREAS))
+    published = 0
+    for i, (area, samples) in enumerate(pending.items()):
+        if not samples:
+            continue
+        topic = TOPICS[area]
+        payload = samples[0] if iterations == 1 else b"[" + b",".join(samples) + b"]"
+        result = pubs[i % len(pubs)].publish(topic, payload, qos=TELEMETRY_QOS)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            log.error("Publish error on %s: %s", topic, result.rc)
+            continue
+        published += 1
+
+    # Summary message per batch (total covers every sample in the batch)
+    summary = _SUMMARY_TMPL % (total_kwh, published, ts)
+    client.publish(SUMMARY_TOPIC, summary, qos=QOS)
+    log.info("📊  Batch summary — Total: %.4f kWh | %d/%d areas | sent: %d  failed: %d",
+             total_kwh, published, len(AREAS), *_publish_totals())
 
 
 # ──────────────────────────────────────────────
@@ -506,6 +704,39 @@ def _handle_signal(sig, frame):
 # ──────────────────────────────────────────────
 # Main
 # ──────────────────────────────────────────────
+def _make_client(client_id: str) -> mqtt.Client:
+    stats = {"sent": 0, "failed": 0}
+    _publish_stats.append(stats)
+    client = mqtt.Client(
+        client_id=client_id,
+        userdata=stats,
+        protocol=mqtt.MQTTv5,
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+    )
+    # Let QoS-1 publishes overlap instead of waiting on each PUBACK in turn
+    client.max_inflight_messages_set(500)
+    client.max_queued_messages_set(1000)
+
+    if USERNAME:
+        client.username_pw_set(USERNAME, PASSWORD)
+
+    client.on_socket_open = _on_socket_open
+    client.on_disconnect  = _on_disconnect
+    client.on_publish     = _on_publish
+    return client
+
+
+def _connect(client: mqtt.Client) -> None:
+    # Retry connection loop
+    while _running:
+        try:
+            client.connect(BROKER, PORT, keepalive=60)
+            break
+        except (ConnectionRefusedError, OSError) as e:
+            log.error("Cannot reach broker (%s). Retrying in 10s…", e)
+            time.sleep(10)
+
+
 def main() -> None:
     signal.signal(signal.SIGINT,  _handle_signal)
     signal.signal(signal.SIGTERM, _handle_signal)
@@ -514,62 +745,65 @@ def main() -> None:
     log.info("  Energy Monitor Simulator Pro v2")
     log.info("  Building : %s", BUILDING_ID)
     log.info("  Mode     : %s", MODE.value)
-    log.info("  Broker   : %s:%s  (QoS=%s)", BROKER, PORT, QOS)
+    log.info("  Broker   : %s:%s  (QoS=%s, telemetry QoS=%s)", BROKER, PORT, QOS, TELEMETRY_QOS)
     log.info("  Areas    : %d", len(AREAS))
     log.info("  Interval : %ss", INTERVAL_SEC)
     log.info("=" * 60)
 
-    client = mqtt.Client(
-        client_id=f"sensor_sim_{BUILDING_ID}",
-        protocol=mqtt.MQTTv311,
-        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
-    )
-
-    if USERNAME:
-        client.username_pw_set(USERNAME, PASSWORD)
+    client = _make_client(f"sensor_sim_{BUILDING_ID}")
 
     # Last Will Testament: marca el sistema como offline si cae sin avisar
     client.will_set(
-        f"{TOPIC_PREFIX}/system/status",
-        json.dumps({"status": "offline", "building": BUILDING_ID,
-                    "ts": datetime.now(timezone.utc).isoformat()}),
+        STATUS_TOPIC,
+        _OFFLINE_TMPL % _utc_now_b(),
         qos=1,
         retain=True,
     )
 
     client.on_connect    = _on_connect
-    client.on_disconnect = _on_disconnect
-    client.on_publish    = _on_publish
     client.on_message    = _on_message
 
-    # Retry connection loop
-    while _running:
-        try:
-            client.connect(BROKER, PORT, keepalive=60)
-            break
-        except (ConnectionRefusedError, OSError) as e:
-            log.error("Cannot reach broker (%s). Retrying in 10s…", e)
-            time.sleep(10)
-
+    _connect(client)
     client.loop_start()
+
+    # FLOOD: extra publish-only connections so readings go out on parallel
+    # sockets. Status, LWT and command subscriptions stay on `client`.
+    shards = [client]
+    if MODE == SimMode.FLOOD:
+        for i in range(1, FLOOD_CLIENTS):
+            extra = _make_client(f"sensor_sim_{BUILDING_ID}_{i}")
+            _connect(extra)
+            extra.loop_start()
+            shards.append(extra)
+        log.info("  Flood    : %d MQTT connections", len(shards))
+
     sim = SensorSimulator()
     cycle = 0
+    next_tick = time.monotonic()
 
     try:
         while _running:
             cycle += 1
             log.info("── Cycle #%d ─────────────────────────────", cycle)
-            publish_batch(client, sim)
-            time.sleep(INTERVAL_SEC)
+            publish_batch(client, sim, shards)
+
+            # Fixed-rate schedule: time spent building and queueing the batch
+            # comes out of the interval instead of accumulating as drift.
+            next_tick += INTERVAL_SEC
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
     finally:
         client.publish(
-            f"{TOPIC_PREFIX}/system/status",
-            json.dumps({"status": "offline", "building": BUILDING_ID,
-                        "ts": datetime.now(timezone.utc).isoformat()}),
+            STATUS_TOPIC,
+            _OFFLINE_TMPL % _utc_now_b(),
             qos=1, retain=True,
         )
-        client.loop_stop()
-        client.disconnect()
+        for c in shards:
+            c.loop_stop()
+            c.disconnect()
         log.info("✅  Simulator stopped cleanly after %d cycles.", cycle)
 
 # ──────────────────────────────────────────────
@@ -607,9 +841,9 @@ def predict_consumption(request: PredictRequest):
 
     # Paso 2: Obtener lecturas base del área
     profile = AREAS[request.area]
-    input_readings = request.last_readings or [
-        round(profile.base * random.uniform(0.8, 1.2), 4) for _ in range(24)
-    ]
+    input_readings = request.last_readings or np.round(
+        profile.base * _rng.uniform(0.8, 1.2, 24), 4
+    ).tolist()
 
     # Paso 3: Construcción de features
     mean_kwh = sum(input_readings) / len(input_readings)
@@ -623,17 +857,18 @@ def predict_consumption(request: PredictRequest):
     }
 
     
-    now_hour = datetime.now().hour
-    predicted = []
-    for i in range(request.horizon_hours):
-        h = (now_hour + i) % 24
-        distance = abs(h - profile.peak_hour)
-        if distance > 12:
-            distance = 24 - distance
-        bell = math.exp(-0.5 * (distance / 3.0) ** 2)
-        factor = 1.0 + (profile.peak_factor - 1.0) * bell
-        val = round(max(0.0, mean_kwh * factor + trend * i + random.gauss(0, 0.05 * mean_kwh)), 4)
-        predicted.append(val)
+    # Paso 4: horizonte completo en una pasada vectorizada
+    steps = np.arange(request.horizon_hours)
+    hours = (time.localtime().tm_hour + steps) % 24
+    distance = np.abs(hours - profile.peak_hour)
+    distance = np.minimum(distance, 24 - distance)
+    bell = np.exp(-distance * distance / 18.0)
+    factor = 1.0 + (profile.peak_factor - 1.0) * bell
+    # abs(): Generator.normal rejects a negative scale (negative readings)
+    noise = _rng.normal(0.0, abs(0.05 * mean_kwh), steps.size)
+    predicted = np.round(
+        np.maximum(0.0, mean_kwh * factor + trend * steps + noise), 4
+    ).tolist()
 
     # Paso 5: Respuesta
     return {